@@ -0,0 +1,60 @@
+"""Auth benchmark: login throughput through the hash pool and per-request token overhead.
+
+Usage: python bench_auth.py [logins] [concurrency]
+"""
+import asyncio
+import sys
+import time
+
+import main
+
+
+async def bench_logins(total: int, concurrency: int):
+    stored = main._hash_password("correct horse battery staple")
+    sem = asyncio.Semaphore(concurrency)
+    lag = 0.0
+
+    async def one():
+        async with sem:
+            assert await main.check_password("correct horse battery staple", stored)
+
+    async def ticker():
+        # The event loop should keep ticking while hashes run on the pool
+        nonlocal lag
+        while True:
+            t = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lag = max(lag, time.perf_counter() - t - 0.01)
+
+    tick = asyncio.create_task(ticker())
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(total)))
+    elapsed = time.perf_counter() - start
+    tick.cancel()
+    print(f"login verify: {total} in {elapsed:.2f}s = {total / elapsed:.1f}/s "
+          f"({main.HASH_WORKERS} workers, concurrency {concurrency}), max loop lag {lag * 1000:.1f} ms")
+
+
+def bench_tokens(n: int = 200000):
+    token = main.issue_token("00000000-0000-0000-0000-000000000000")
+
+    main.token_cache.clear()
+    start = time.perf_counter()
+    for _ in range(n):
+        main.token_cache.clear()
+        main.verify_token(token)
+    cold = (time.perf_counter() - start) / n
+
+    start = time.perf_counter()
+    for _ in range(n):
+        main.verify_token(token)
+    warm = (time.perf_counter() - start) / n
+
+    print(f"token verify: cold {cold * 1e6:.2f} us/request, cached {warm * 1e6:.2f} us/request")
+
+
+if __name__ == "__main__":
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    bench_tokens()
+    asyncio.run(bench_logins(total, concurrency))
@@ -1,12 +1,28 @@
 import sqlite3
+import argparse
+import gzip
+import itertools
+import re
+import functools
+import fcntl
 import json
 import os
+import asyncio
+import math
+import random
+import hashlib
+import hmac
+import secrets
 import uuid
 import time
 import shutil
+import sys
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, UploadFile, File, Form, BackgroundTasks
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, UploadFile, File, Form, BackgroundTasks, Depends, HTTPException
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 import aiofiles
@@ -17,8 +33,67 @@ app = FastAPI()
 # --- Config & Setup ---
 DB_NAME = "kralgram.db"
 UPLOAD_DIR = "static/uploads"
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "archive")
+# Messages older than this move from the hot table into compressed per-room segments
+ARCHIVE_AFTER = float(os.environ.get("ARCHIVE_AFTER_DAYS", 30)) * 86400
+ARCHIVE_INTERVAL = float(os.environ.get("ARCHIVE_INTERVAL", 3600))
+ARCHIVE_SEGMENT_SIZE = int(os.environ.get("ARCHIVE_SEGMENT_SIZE", 5000))
+PROFILE_CACHE_SIZE = int(os.environ.get("PROFILE_CACHE_SIZE", 50000))
+ROOM_CACHE_SIZE = int(os.environ.get("ROOM_CACHE_SIZE", 20000))
+# Invalidation is per worker; the TTL bounds how long other workers can serve a stale avatar
+PROFILE_CACHE_TTL = float(os.environ.get("PROFILE_CACHE_TTL", 30))
+TRACE_BUFFER_SIZE = int(os.environ.get("TRACE_BUFFER_SIZE", 5000))
+SLOW_OP_MS = float(os.environ.get("SLOW_OP_MS", 200))
+PROFILE_MAX_SECONDS = 60
+# Comma-separated user ids allowed to use /api/admin/*
+ADMIN_IDS = set(filter(None, os.environ.get("ADMIN_IDS", "").split(",")))
+MESSAGE_PAGE = 100
+MESSAGE_PAGE_MAX = 500
+# Heartbeat: ping idle sockets every HEARTBEAT_INTERVAL seconds, reap them after HEARTBEAT_TIMEOUT of silence
+HEARTBEAT_INTERVAL = float(os.environ.get("HEARTBEAT_INTERVAL", 25))
+HEARTBEAT_TIMEOUT = float(os.environ.get("HEARTBEAT_TIMEOUT", 60))
+HEARTBEAT_TICK = float(os.environ.get("HEARTBEAT_TICK", 1))
+# Admission control: new sockets per second (and burst) before connects are delayed, then shed
+CONNECT_RATE = float(os.environ.get("CONNECT_RATE", 200))
+CONNECT_BURST = float(os.environ.get("CONNECT_BURST", 400))
+CONNECT_MAX_WAIT = float(os.environ.get("CONNECT_MAX_WAIT", 2))
+# Graceful drain: clients are told to come back after RECONNECT_BASE_MS plus up to RECONNECT_JITTER_MS
+RECONNECT_BASE_MS = int(os.environ.get("RECONNECT_BASE_MS", 1000))
+RECONNECT_JITTER_MS = int(os.environ.get("RECONNECT_JITTER_MS", 15000))
+DRAIN_WAVES = int(os.environ.get("DRAIN_WAVES", 10))
+DRAIN_WAVE_DELAY = float(os.environ.get("DRAIN_WAVE_DELAY", 0.5))
+DRAIN_FLUSH_TIMEOUT = float(os.environ.get("DRAIN_FLUSH_TIMEOUT", 5))
+# Per-user rate limits as (tokens per second, burst). Group sends are charged per recipient.
+RATE_LIMITS = {
+    "message": (5, 20),
+    "group_fanout": (2000, 10000),
+    "read": (20, 100),
+    "upload": (0.5, 5),
+}
+RATE_BUCKET_TTL = float(os.environ.get("RATE_BUCKET_TTL", 300))
+# Sessions: SECRET_KEY signs tokens; without it a key is generated once and kept in SECRET_KEY_FILE
+SECRET_KEY_FILE = os.environ.get("SECRET_KEY_FILE", "secret.key")
+TOKEN_TTL = int(os.environ.get("TOKEN_TTL", 30 * 86400))
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", 100000))
+# scrypt cost (n=2**14, r=8 -> 16 MiB per hash); hashing runs on a dedicated thread pool
+SCRYPT_N, SCRYPT_R, SCRYPT_P = 2 ** 14, 8, 1
+HASH_WORKERS = int(os.environ.get("HASH_WORKERS", os.cpu_count() or 2))
 
 os.makedirs(UPLOAD_DIR, exist_ok=True)
+os.makedirs(ARCHIVE_DIR, exist_ok=True)
+
+def load_secret_key() -> bytes:
+    # Shared by every worker and kept across restarts, so sessions survive both
+    if os.environ.get("SECRET_KEY"): return os.environ["SECRET_KEY"].encode()
+    try:
+        fd = os.open(SECRET_KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as f: f.write(secrets.token_hex(32))
+    except FileExistsError: pass
+    with open(SECRET_KEY_FILE) as f: key = f.read().strip()
+    if not key: raise RuntimeError(f"{SECRET_KEY_FILE} is empty; set SECRET_KEY or delete the file")
+    return key.encode()
+
+SECRET_KEY = load_secret_key()
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 # --- HTML Content ---
@@ -231,7 +306,11 @@ html_content = """
     <script>
         // --- State ---
         let user = JSON.parse(localStorage.getItem('kral_user')) || null;
+        if(user && !user.token) user = null; // sessions from before tokens existed
         let ws = null;
+        let wsRetries = 0;
+        let wsRetryAfter = null;
+        let history = {roomId: null, oldest: null, hasMore: false, loading: false};
         let currentChat = null;
         let mediaRecorder = null;
         let audioChunks = [];
@@ -277,7 +356,7 @@ html_content = """
             if(currentChat.type === 'group') {
                 groupSec.classList.remove('hidden');
                 // Fetch info
-                const res = await fetch(`/api/group_info/${currentChat.id}`);
+                const res = await api(`/api/group_info/${currentChat.id}`);
                 const data = await res.json();
                 document.getElementById('groupInviteLink').innerText = data.invite_link;
             } else {
@@ -285,6 +364,14 @@ html_content = """
             }
         }
 
+        // Authenticated fetch; an expired session sends the user back to login
+        async function api(url, opts = {}) {
+            opts.headers = {...(opts.headers || {}), 'Authorization': `Bearer ${user.token}`};
+            const res = await fetch(url, opts);
+            if(res.status === 401) { localStorage.removeItem('kral_user'); location.reload(); }
+            return res;
+        }
+
         function closeModal(id) { document.getElementById(id).classList.remove('open'); }
         
         function copyToClipboard(elemId) {
@@ -338,13 +425,31 @@ html_content = """
         // --- WebSocket & Real-time ---
         function connectWS() {
             const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-            ws = new WebSocket(`${protocol}//${window.location.host}/ws/${user.id}`);
+            ws = new WebSocket(`${protocol}//${window.location.host}/ws/${user.id}?token=${encodeURIComponent(user.token)}`);
+            ws.onopen = () => { wsRetries = 0; };
             ws.onmessage = (e) => {
                 const data = JSON.parse(e.data);
-                if (data.action === "new_message") handleNewMessage(data);
+                if (data.action === "ping") ws.send(JSON.stringify({action: 'pong'}));
+                else if (data.action === "error") showToast(data.error);
+                else if (data.action === "reconnect") wsRetryAfter = data.after_ms;
+                else if (data.action === "new_message") handleNewMessage(data);
                 else if (data.action === "status_update") updateMessageStatus(data.msg_id);
             };
-            ws.onclose = () => setTimeout(connectWS, 3000);
+            ws.onclose = (e) => {
+                // 1008: the server rejected our session, same as an HTTP 401
+                if (e.code === 1008) { localStorage.removeItem('kral_user'); location.reload(); return; }
+                // 4001: this user connected again elsewhere (e.g. another tab); don't fight over the slot
+                if (e.code === 4001) return;
+                // Server-directed delay wins. A bare restart/going-away close (no reconnect frame, e.g. plain
+                // `uvicorn main:app`) hits every client at once, so spread those over the same window the
+                // server's drain uses; otherwise full-jitter exponential backoff capped at 30s.
+                let delay = wsRetryAfter;
+                if (delay === null && (e.code === 1012 || e.code === 1001)) delay = 1000 + Math.random() * 15000;
+                if (delay === null) delay = Math.random() * Math.min(30000, 1000 * 2 ** wsRetries);
+                wsRetryAfter = null;
+                wsRetries++;
+                setTimeout(connectWS, delay);
+            };
         }
 
         function handleNewMessage(data) {
@@ -371,7 +476,7 @@ html_content = """
         }
 
         async function loadChats() {
-            const res = await fetch(`/api/my_chats/${user.id}`);
+            const res = await api(`/api/my_chats/${user.id}`);
             const data = await res.json();
             const list = document.getElementById('chatList');
             list.innerHTML = "";
@@ -418,14 +523,33 @@ html_content = """
 
             const list = document.getElementById('messagesList');
             list.innerHTML = '';
-            
-            const res = await fetch(`/api/messages/${loadId}`);
-            const msgs = await res.json();
-            msgs.forEach(m => renderMessage(m));
+            history = {roomId: loadId, oldest: null, hasMore: true, loading: false};
+            await loadOlder();
             scrollToBottom();
         }
 
-        function renderMessage(msg) {
+        // Pages backwards through history (the server reads through into the archive)
+        async function loadOlder() {
+            if(!history.hasMore || history.loading) return;
+            history.loading = true;
+            const roomId = history.roomId;
+            const before = history.oldest !== null ? `?before=${history.oldest}` : '';
+            const res = await api(`/api/messages/${roomId}${before}`);
+            const msgs = await res.json();
+            if(roomId !== history.roomId) return;
+            const list = document.getElementById('messagesList');
+            const fromBottom = list.scrollHeight - list.scrollTop;
+            msgs.slice().reverse().forEach(m => renderMessage(m, true));
+            list.scrollTop = list.scrollHeight - fromBottom;
+            if(msgs.length) history.oldest = msgs[0].timestamp;
+            history.hasMore = msgs.length > 0;
+            history.loading = false;
+        }
+        document.getElementById('messagesList').addEventListener('scroll', (e) => {
+            if(e.target.scrollTop < 80) loadOlder();
+        });
+
+        function renderMessage(msg, prepend = false) {
             const isMe = msg.sender_id === user.id;
             const list = document.getElementById('messagesList');
             
@@ -449,7 +573,7 @@ html_content = """
                     <div class="h-4 w-full"></div>
                 </div>
             </div>`;
-            list.insertAdjacentHTML('beforeend', html);
+            list.insertAdjacentHTML(prepend ? 'afterbegin' : 'beforeend', html);
         }
 
         // --- Actions ---
@@ -473,8 +597,9 @@ html_content = """
             showToast("در حال ارسال...");
             const form = new FormData();
             form.append('file', file);
-            const res = await fetch('/api/upload', {method:'POST', body:form});
+            const res = await api('/api/upload', {method:'POST', body:form});
             const data = await res.json();
+            if(!res.ok) return showToast(data.error);
             
             let type = 'text';
             if(data.type.startsWith('image')) type = 'image';
@@ -495,7 +620,7 @@ html_content = """
             const form = new FormData();
             form.append('file', file);
             form.append('user_id', user.id);
-            const res = await fetch('/api/update_avatar', {method:'POST', body:form});
+            const res = await api('/api/update_avatar', {method:'POST', body:form});
             const data = await res.json();
             
             user.avatar = data.url;
@@ -513,7 +638,7 @@ html_content = """
             const query = document.getElementById('searchInput').value.trim();
             if(!query) return;
             
-            const res = await fetch(`/api/search_user?query=${query}`);
+            const res = await api(`/api/search_user?query=${encodeURIComponent(query)}`);
             const data = await res.json();
             
             if(data.error) showToast("کاربر یافت نشد");
@@ -529,7 +654,7 @@ html_content = """
             if(!name) return;
             const form = new FormData();
             form.append('name', name); form.append('user_id', user.id);
-            await fetch('/api/create_group', {method:'POST', body:form});
+            await api('/api/create_group', {method:'POST', body:form});
             loadChats();
             document.getElementById('groupNameInp').value = "";
             showToast("گروه ساخته شد");
@@ -539,7 +664,7 @@ html_content = """
             const link = document.getElementById('inviteLinkInp').value;
             const form = new FormData();
             form.append('invite_link', link); form.append('user_id', user.id);
-            const res = await fetch('/api/join_group', {method:'POST', body:form});
+            const res = await api('/api/join_group', {method:'POST', body:form});
             if(res.ok) { loadChats(); showToast("عضو شدید!"); }
             else showToast("لینک نامعتبر");
         }
@@ -587,13 +712,19 @@ html_content = """
 
 # --- Backend ---
 
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
+def init_db(db_name: str = DB_NAME):
+    conn = sqlite3.connect(db_name)
     c = conn.cursor()
+    # WAL lets exports read a consistent snapshot without blocking live writers
+    c.execute("PRAGMA journal_mode=WAL")
     c.execute('''CREATE TABLE IF NOT EXISTS users (id TEXT PRIMARY KEY, name TEXT, username TEXT UNIQUE, password TEXT, avatar TEXT)''')
     c.execute('''CREATE TABLE IF NOT EXISTS rooms (id TEXT PRIMARY KEY, type TEXT, name TEXT, invite_link TEXT)''')
     c.execute('''CREATE TABLE IF NOT EXISTS room_members (room_id TEXT, user_id TEXT, PRIMARY KEY (room_id, user_id))''')
     c.execute('''CREATE TABLE IF NOT EXISTS messages (id TEXT PRIMARY KEY, room_id TEXT, sender_id TEXT, content TEXT, msg_type TEXT, status TEXT, timestamp REAL)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_messages_room_ts ON messages (room_id, timestamp)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_messages_ts ON messages (timestamp)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS archive_segments (room_id TEXT, path TEXT, offset INTEGER, length INTEGER, first_ts REAL, last_ts REAL, count INTEGER)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_archive_room_ts ON archive_segments (room_id, last_ts)''')
     conn.commit()
     conn.close()
 
@@ -618,6 +749,184 @@ def cleanup_storage():
             except Exception as e:
                 print(f"Error deleting {filename}: {e}")
 
+# --- Tracing & profiling ---
+trace_buffer: deque = deque(maxlen=TRACE_BUFFER_SIZE)
+
+class Trace:
+    """Times one operation as a sequence of phases: each mark() closes the phase that
+    started at the previous mark. finish() pushes the span to the ring buffer and logs it if slow."""
+    __slots__ = ("start", "last", "phases")
+    def __init__(self):
+        self.start = self.last = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + (now - self.last) * 1000
+        self.last = now
+
+    def finish(self, name: str, **attrs):
+        ms = (time.perf_counter() - self.start) * 1000
+        span = {"name": name, "at": time.time(), "ms": round(ms, 3), "phases": {k: round(v, 3) for k, v in self.phases.items()}, **attrs}
+        trace_buffer.append(span)
+        if ms >= SLOW_OP_MS: print(f"Slow {name}: {ms:.1f} ms {span['phases']} {attrs or ''}")
+
+def sample_stacks(thread_id: int, seconds: float, interval: float) -> str:
+    """Samples one thread's Python stack and returns it in collapsed-stack format
+    (`root;...;leaf count` per line), ready for flamegraph.pl or speedscope."""
+    counts: Dict[str, int] = {}
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        if stack:
+            key = ";".join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+        time.sleep(interval)
+    return "".join(f"{stack} {n}\n" for stack, n in sorted(counts.items(), key=lambda kv: -kv[1]))
+
+profiler_lock = threading.Lock()
+
+# --- Profile & room metadata cache ---
+class LRUCache:
+    """Bounded LRU with a per-entry TTL and hit/miss counters. Values are shared, so callers must not mutate them."""
+    def __init__(self, maxsize: int, ttl: float = PROFILE_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys):
+        """Returns ({key: value} for cached keys, [keys that missed])."""
+        found, missing = {}, []
+        now = time.monotonic()
+        for key in keys:
+            entry = self.data.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None: del self.data[key]
+                missing.append(key)
+            else:
+                self.data.move_to_end(key)
+                found[key] = entry[1]
+        self.hits += len(found)
+        self.misses += len(missing)
+        return found, missing
+
+    def put(self, key: str, value):
+        self.data[key] = (time.monotonic() + self.ttl, value)
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize: self.data.popitem(last=False)
+        return value
+
+    def invalidate(self, key: str):
+        self.data.pop(key, None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"size": len(self.data), "hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / total, 4) if total else 0.0}
+
+# Rarely-changing fields only; mutating routes write through to these
+profile_cache = LRUCache(PROFILE_CACHE_SIZE)   # user id -> {id, name, username, avatar}
+username_cache = LRUCache(PROFILE_CACHE_SIZE, ttl=float("inf"))  # username -> user id (usernames never change)
+room_cache = LRUCache(ROOM_CACHE_SIZE)         # room id -> {id, type, name, invite_link}
+
+def _batch_get(cache: LRUCache, conn, query: str, ids) -> Dict[str, dict]:
+    ids = list(dict.fromkeys(ids))
+    found, missing = cache.get_many(ids)
+    for i in range(0, len(missing), 500):
+        chunk = missing[i:i + 500]
+        for row in conn.execute(query.format(marks=",".join("?" * len(chunk))), chunk):
+            found[row['id']] = cache.put(row['id'], dict(row))
+    # Keep the caller's order regardless of which entries were cached
+    return {i: found[i] for i in ids if i in found}
+
+def get_users(conn, ids) -> Dict[str, dict]:
+    """Profiles for `ids` in one cache pass; misses are fetched with a single IN query."""
+    return _batch_get(profile_cache, conn, "SELECT id, name, username, avatar FROM users WHERE id IN ({marks})", ids)
+
+def get_rooms(conn, ids) -> Dict[str, dict]:
+    return _batch_get(room_cache, conn, "SELECT id, type, name, invite_link FROM rooms WHERE id IN ({marks})", ids)
+
+# --- Archive: cold message segments ---
+# Each room has one append-only file of gzip members ("segments"); archive_segments
+# records where each segment lives and the time range it covers.
+def _archive_path(room_id: str) -> str:
+    return os.path.join(ARCHIVE_DIR, re.sub(r"[^\w-]", "_", room_id) + ".seg")
+
+def archive_messages(db_name: str = DB_NAME, older_than: float = ARCHIVE_AFTER) -> int:
+    """Moves messages older than `older_than` seconds into segment files, one
+    segment of up to ARCHIVE_SEGMENT_SIZE messages at a time. Returns the count moved."""
+    cutoff = time.time() - older_than
+    conn = sqlite3.connect(db_name, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    moved = 0
+    try:
+        rooms = [r[0] for r in conn.execute("SELECT DISTINCT room_id FROM messages WHERE timestamp < ?", (cutoff,))]
+        for room_id in rooms:
+            while True:
+                # Other workers (or the CLI) may archive concurrently: take the write lock before
+                # reading, so rows selected here are still present and can't be archived twice
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    rows = conn.execute("SELECT * FROM messages WHERE room_id=? AND timestamp < ? ORDER BY timestamp LIMIT ?",
+                                        (room_id, cutoff, ARCHIVE_SEGMENT_SIZE)).fetchall()
+                    if not rows:
+                        conn.execute("COMMIT")
+                        break
+                    data = gzip.compress("".join(json.dumps(dict(r), ensure_ascii=False) + "\n" for r in rows).encode())
+                    path = _archive_path(room_id)
+                    # The segment is durable before the hot rows go; a crash in between only leaves unreferenced bytes
+                    with open(path, "ab") as seg:
+                        fcntl.flock(seg.fileno(), fcntl.LOCK_EX)
+                        offset = os.fstat(seg.fileno()).st_size
+                        seg.write(data)
+                        seg.flush()
+                        os.fsync(seg.fileno())
+                    conn.execute("INSERT INTO archive_segments VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                 (room_id, path, offset, len(data), rows[0]['timestamp'], rows[-1]['timestamp'], len(rows)))
+                    conn.executemany("DELETE FROM messages WHERE id=?", [(r['id'],) for r in rows])
+                    conn.execute("COMMIT")
+                except BaseException:
+                    if conn.in_transaction: conn.execute("ROLLBACK")
+                    raise
+                moved += len(rows)
+    finally: conn.close()
+    if moved: print(f"Archived {moved} messages")
+    return moved
+
+@functools.lru_cache(maxsize=64)
+def read_segment(path: str, offset: int, length: int) -> tuple:
+    # Segments are immutable once written, so decoded ones can be cached by location
+    with open(path, "rb") as seg:
+        seg.seek(offset)
+        data = gzip.decompress(seg.read(length))
+    return tuple(json.loads(line) for line in data.decode().splitlines() if line)
+
+def read_archive(room_id: str, before: float, limit: int, db_name: str = DB_NAME) -> List[dict]:
+    """The newest `limit` archived messages of a room older than `before`, oldest first."""
+    conn = sqlite3.connect(db_name)
+    try:
+        segments = conn.execute("SELECT path, offset, length FROM archive_segments WHERE room_id=? AND first_ts < ? ORDER BY last_ts DESC",
+                                (room_id, before)).fetchall()
+    finally: conn.close()
+    out: List[dict] = []
+    for path, offset, length in segments:
+        older = [m for m in read_segment(path, offset, length) if m["timestamp"] < before]
+        out[:0] = older[-(limit - len(out)):]
+        if len(out) >= limit: break
+    return out
+
+async def archive_loop():
+    while True:
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+        try: await asyncio.get_running_loop().run_in_executor(None, archive_messages)
+        except Exception as e: print(f"Archive run failed: {e}")
+
 # --- Models ---
 class UserLogin(BaseModel):
     username: str
@@ -628,22 +937,311 @@ class UserRegister(BaseModel):
     username: str
     password: str
 
+# --- Auth ---
+hash_pool = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="pwhash")
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * r * n + 1024 * 1024, dklen=32)
+
+def _hash_password(password: str) -> str:
+    salt = secrets.token_bytes(16)
+    digest = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${digest.hex()}"
+
+def _check_password(password: str, stored: str) -> bool:
+    if not stored.startswith("scrypt$"):
+        # Legacy plaintext row; login upgrades it to a hash on success
+        return hmac.compare_digest(password.encode(), stored.encode())
+    _, n, r, p, salt, digest = stored.split("$")
+    return hmac.compare_digest(_scrypt(password, bytes.fromhex(salt), int(n), int(r), int(p)), bytes.fromhex(digest))
+
+async def hash_password(password: str) -> str:
+    return await asyncio.get_running_loop().run_in_executor(hash_pool, _hash_password, password)
+
+async def check_password(password: str, stored: str) -> bool:
+    return await asyncio.get_running_loop().run_in_executor(hash_pool, _check_password, password, stored)
+
+def _sign(payload: str) -> str:
+    return hmac.new(SECRET_KEY, payload.encode(), hashlib.sha256).hexdigest()
+
+def issue_token(user_id: str) -> str:
+    payload = f"{user_id}.{int(time.time()) + TOKEN_TTL}"
+    return f"{payload}.{_sign(payload)}"
+
+# token -> (user_id, expiry); bounded LRU so repeat requests skip the HMAC and parsing
+token_cache: "OrderedDict[str, tuple]" = OrderedDict()
+
+def verify_token(token: str):
+    """Returns the user id for a valid, unexpired token, else None."""
+    hit = token_cache.get(token)
+    if hit is not None:
+        if hit[1] > time.time():
+            token_cache.move_to_end(token)
+            return hit[0]
+        del token_cache[token]
+        return None
+    # Real tokens are pure ASCII; anything else from a query string is rejected before hashing
+    if not token.isascii(): return None
+    payload, _, sig = token.rpartition(".")
+    if not payload or not hmac.compare_digest(sig.encode(), _sign(payload).encode()): return None
+    user_id, _, exp = payload.rpartition(".")
+    if not exp.isdigit() or int(exp) <= time.time(): return None
+    token_cache[token] = (user_id, int(exp))
+    if len(token_cache) > TOKEN_CACHE_SIZE: token_cache.popitem(last=False)
+    return user_id
+
+def current_user(request: Request) -> str:
+    # Header only: tokens in URLs leak into access logs and Referer (the websocket reads ?token= itself)
+    auth = request.headers.get("authorization", "")
+    token = auth[7:] if auth[:7].lower() == "bearer " else ""
+    user_id = verify_token(token)
+    if not user_id: raise HTTPException(401, "نشست نامعتبر است، دوباره وارد شوید")
+    return user_id
+
+def require_self(user_id: str, uid: str):
+    if user_id != uid: raise HTTPException(403, "دسترسی غیرمجاز")
+
+def is_member(conn, room_id: str, uid: str) -> bool:
+    # Private rooms are "<uidA>_<uidB>" (uuids never contain "_"); groups are checked against room_members
+    if uid in room_id.split("_") and room_id.count("_") == 1: return True
+    return conn.execute("SELECT 1 FROM room_members WHERE room_id=? AND user_id=?", (room_id, uid)).fetchone() is not None
+
+def require_member(conn, room_id: str, uid: str):
+    if not is_member(conn, room_id, uid): raise HTTPException(403, "دسترسی غیرمجاز")
+
+def admin_user(uid: str = Depends(current_user)) -> str:
+    if uid not in ADMIN_IDS: raise HTTPException(403, "دسترسی غیرمجاز")
+    return uid
+
+@app.exception_handler(HTTPException)
+async def http_error(request: Request, exc: HTTPException):
+    return JSONResponse({"error": exc.detail}, exc.status_code)
+
 # --- WebSocket ---
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, holding at most `capacity`."""
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, cost: float = 1.0, max_wait: float = 0.0):
+        """Spend `cost` tokens. Returns the seconds the caller should wait first
+        (0 when tokens are on hand), or None if that wait would exceed `max_wait`."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = max(0.0, (cost - self.tokens) / self.rate)
+        if wait > max_wait: return None
+        self.tokens -= cost
+        return wait
+
+class RateLimiter:
+    """Token buckets keyed by (user, action). Buckets live in an LRU so every
+    check is O(1) and buckets idle longer than `ttl` (i.e. full again) are dropped."""
+    def __init__(self, limits: Dict[str, tuple], ttl: float = RATE_BUCKET_TTL):
+        self.limits = limits
+        self.ttl = ttl
+        self.buckets: "OrderedDict[tuple, TokenBucket]" = OrderedDict()
+        self.stats = {"allowed": 0, "limited": 0, "evicted": 0}
+
+    def check(self, user_id: str, action: str, cost: float = 1.0) -> float:
+        """Returns 0 if the action may proceed, otherwise seconds until it would."""
+        key = (user_id, action)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(*self.limits[action])
+        else: self.buckets.move_to_end(key)
+        self.evict()
+        cost = min(cost, bucket.capacity)
+        if bucket.take(cost) is None:
+            self.stats["limited"] += 1
+            return (cost - bucket.tokens) / bucket.rate
+        self.stats["allowed"] += 1
+        return 0.0
+
+    def refund(self, user_id: str, action: str, cost: float = 1.0):
+        """Gives back tokens spent by a check whose action was then refused by another bucket."""
+        bucket = self.buckets.get((user_id, action))
+        if bucket is not None: bucket.tokens = min(bucket.capacity, bucket.tokens + cost)
+
+    def evict(self):
+        limit = time.monotonic() - self.ttl
+        while self.buckets:
+            key, bucket = next(iter(self.buckets.items()))
+            if bucket.updated > limit: break
+            del self.buckets[key]
+            self.stats["evicted"] += 1
+
+limiter = RateLimiter(RATE_LIMITS)
+
+FORBIDDEN_FRAME = {"action": "error", "code": "forbidden", "error": "دسترسی غیرمجاز"}
+
+def rate_limited_frame(action: str, retry_after: float) -> dict:
+    return {"action": "error", "code": "rate_limited", "for": action, "retry_after": round(retry_after, 2), "error": "ارسال بیش از حد مجاز، کمی صبر کنید"}
+
 class ConnectionManager:
-    def __init__(self):
+    """Tracks live sockets and keeps them honest with a heartbeat.
+
+    Liveness is checked by a single timer wheel instead of one timer per socket:
+    every tick the reaper looks only at the slot that just came due, pings sockets
+    that have been quiet for HEARTBEAT_INTERVAL and evicts the ones silent for
+    HEARTBEAT_TIMEOUT. Incoming frames only bump `last_seen`, so the hot path is O(1).
+    """
+    def __init__(self, interval: float = HEARTBEAT_INTERVAL, timeout: float = HEARTBEAT_TIMEOUT, tick: float = HEARTBEAT_TICK):
         self.active_connections: Dict[str, WebSocket] = {}
-    async def connect(self, websocket: WebSocket, user_id: str):
+        self.last_seen: Dict[str, float] = {}
+        self.interval = interval
+        self.timeout = timeout
+        self.tick = tick
+        self.wheel: List[set] = [set() for _ in range(int(math.ceil(max(interval, timeout) / tick)) + 2)]
+        self.slot_of: Dict[str, int] = {}
+        self.cursor = 0
+        self.tasks: set = set()
+        self.admission = TokenBucket(CONNECT_RATE, CONNECT_BURST)
+        self.draining = False
+        self.pending_sends = 0
+        self.stats = {"pings_sent": 0, "reaped": 0, "connects_delayed": 0, "connects_shed": 0, "drained": 0}
+
+    async def connect(self, websocket: WebSocket, user_id: str) -> bool:
+        # Admission control: short overloads are smoothed by delaying, longer ones are shed
+        wait = None if self.draining else self.admission.take(max_wait=CONNECT_MAX_WAIT)
+        if wait is None:
+            self.stats["connects_shed"] += 1
+            await websocket.accept()
+            await self._send_reconnect(websocket, code=1013)
+            return False
+        if wait:
+            self.stats["connects_delayed"] += 1
+            await asyncio.sleep(wait)
         await websocket.accept()
+        replaced = self.active_connections.get(user_id)
         self.active_connections[user_id] = websocket
-    def disconnect(self, user_id: str):
+        # A reconnect supersedes the old (often half-open) socket, which the wheel no longer tracks
+        if replaced is not None: self._spawn(self._close(replaced, code=4001))
+        self.touch(user_id)
+        self.schedule(user_id, self.interval)
+        return True
+
+    def disconnect(self, user_id: str, websocket: WebSocket = None):
+        # A reconnect may already have replaced this socket; don't evict the new one
+        if websocket is not None and self.active_connections.get(user_id) is not websocket: return
         if user_id in self.active_connections: del self.active_connections[user_id]
+        self.last_seen.pop(user_id, None)
+        slot = self.slot_of.pop(user_id, None)
+        if slot is not None: self.wheel[slot].discard(user_id)
+
+    def touch(self, user_id: str):
+        self.last_seen[user_id] = time.monotonic()
+
+    def schedule(self, user_id: str, delay: float):
+        slot = self.slot_of.get(user_id)
+        if slot is not None: self.wheel[slot].discard(user_id)
+        ahead = min(max(1, int(math.ceil(delay / self.tick))), len(self.wheel) - 1)
+        slot = (self.cursor + ahead) % len(self.wheel)
+        self.wheel[slot].add(user_id)
+        self.slot_of[user_id] = slot
+
     async def send_personal_message(self, message: dict, user_id: str):
         if user_id in self.active_connections:
-            await self.active_connections[user_id].send_text(json.dumps(message))
+            self.pending_sends += 1
+            try: await self.active_connections[user_id].send_text(json.dumps(message))
+            finally: self.pending_sends -= 1
+
+    async def _send_reconnect(self, websocket: WebSocket, code: int):
+        after_ms = RECONNECT_BASE_MS + random.randint(0, RECONNECT_JITTER_MS)
+        async def send_and_close():
+            await websocket.send_text(json.dumps({"action": "reconnect", "after_ms": after_ms}))
+            await websocket.close(code=code)
+        # One unresponsive peer must not hold up its drain wave or the shed path
+        try: await asyncio.wait_for(send_and_close(), timeout=self.tick)
+        except Exception: pass
+
+    async def drain(self):
+        """Graceful shutdown: stop admitting, let in-flight sends finish, then tell
+        clients to reconnect later (with jitter) and close them in waves."""
+        if self.draining: return
+        self.draining = True
+        deadline = time.monotonic() + DRAIN_FLUSH_TIMEOUT
+        while self.pending_sends and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        conns = list(self.active_connections.items())
+        size = max(1, math.ceil(len(conns) / max(1, DRAIN_WAVES)))
+        for i in range(0, len(conns), size):
+            wave = conns[i:i + size]
+            for user_id, websocket in wave: self.disconnect(user_id, websocket)
+            await asyncio.gather(*(self._send_reconnect(websocket, code=1012) for _, websocket in wave))
+            self.stats["drained"] += len(wave)
+            if i + size < len(conns): await asyncio.sleep(DRAIN_WAVE_DELAY)
+
+    async def _ping(self, user_id: str, websocket: WebSocket):
+        try:
+            # A half-open peer with a full send buffer never completes the send; treat that as dead
+            await asyncio.wait_for(websocket.send_text(json.dumps({"action": "ping"})), timeout=self.tick)
+            self.stats["pings_sent"] += 1
+        except Exception:
+            await self._reap(user_id, websocket)
+
+    async def _close(self, websocket: WebSocket, code: int):
+        try: await asyncio.wait_for(websocket.close(code=code), timeout=self.tick)
+        except Exception: pass
+
+    async def _reap(self, user_id: str, websocket: WebSocket):
+        self.disconnect(user_id, websocket)
+        self.stats["reaped"] += 1
+        await self._close(websocket, code=1001)
+
+    async def heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            self.cursor = (self.cursor + 1) % len(self.wheel)
+            due, self.wheel[self.cursor] = self.wheel[self.cursor], set()
+            now = time.monotonic()
+            for user_id in due:
+                self.slot_of.pop(user_id, None)
+                websocket = self.active_connections.get(user_id)
+                if websocket is None: continue
+                idle = now - self.last_seen.get(user_id, now)
+                if idle >= self.timeout:
+                    self._spawn(self._reap(user_id, websocket))
+                    continue
+                if idle >= self.interval:
+                    self._spawn(self._ping(user_id, websocket))
+                    self.schedule(user_id, min(self.interval, self.timeout - idle))
+                else:
+                    self.schedule(user_id, self.interval - idle)
+
+    def _spawn(self, coro):
+        # Fire-and-forget so one slow peer can't hold up the wheel; keep a reference until done
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
 
 manager = ConnectionManager()
 
+@app.on_event("startup")
+async def start_heartbeat():
+    asyncio.create_task(manager.heartbeat_loop())
+    asyncio.create_task(archive_loop())
+
+class DrainingServer(uvicorn.Server):
+    # uvicorn closes websockets before lifespan shutdown runs, so a shutdown hook would be too late;
+    # the graceful drain needs `python main.py`, which runs this server class
+    async def shutdown(self, sockets=None):
+        await manager.drain()
+        await super().shutdown(sockets=sockets)
+
 # --- Routes ---
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    trace = Trace()
+    try: return await call_next(request)
+    finally:
+        route = request.scope.get("route")
+        trace.finish(f"{request.method} {getattr(route, 'path', request.url.path)}")
+
 @app.get("/", response_class=HTMLResponse)
 async def get(): return HTMLResponse(content=html_content)
 
@@ -654,24 +1252,39 @@ async def register(user: UserRegister):
         curr = conn.cursor()
         curr.execute("SELECT * FROM users WHERE username=?", (user.username,))
         if curr.fetchone(): return JSONResponse({"error": "نام کاربری تکراری"}, 400)
+        password = await hash_password(user.password)
         uid = str(uuid.uuid4())
-        curr.execute("INSERT INTO users VALUES (?, ?, ?, ?, ?)", (uid, user.name, user.username, user.password, "default"))
+        try: curr.execute("INSERT INTO users VALUES (?, ?, ?, ?, ?)", (uid, user.name, user.username, password, "default"))
+        except sqlite3.IntegrityError: return JSONResponse({"error": "نام کاربری تکراری"}, 400)
         conn.commit()
-        return {"id": uid, "name": user.name, "username": user.username, "avatar": "default"}
+        profile_cache.put(uid, {"id": uid, "name": user.name, "username": user.username, "avatar": "default"})
+        return {"id": uid, "name": user.name, "username": user.username, "avatar": "default", "token": issue_token(uid)}
     finally: conn.close()
 
 @app.post("/api/login")
 async def login(user: UserLogin):
     conn = get_db_connection()
     curr = conn.cursor()
-    curr.execute("SELECT * FROM users WHERE username=? AND password=?", (user.username, user.password))
+    curr.execute("SELECT * FROM users WHERE username=?", (user.username,))
     row = curr.fetchone()
     conn.close()
-    if row: return {"id": row['id'], "name": row['name'], "username": row['username'], "avatar": row['avatar']}
+    if row and await check_password(user.password, row['password']):
+        if not row['password'].startswith("scrypt$"):
+            conn = get_db_connection()
+            conn.execute("UPDATE users SET password=? WHERE id=?", (await hash_password(user.password), row['id']))
+            conn.commit()
+            conn.close()
+        profile = profile_cache.put(row['id'], {"id": row['id'], "name": row['name'], "username": row['username'], "avatar": row['avatar']})
+        return {**profile, "token": issue_token(row['id'])}
     return JSONResponse({"error": "اطلاعات اشتباه است"}, 401)
 
 @app.post("/api/upload")
-async def upload_file(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
+async def upload_file(background_tasks: BackgroundTasks, file: UploadFile = File(...), uid: str = Depends(current_user)):
+    retry_after = limiter.check(uid, "upload")
+    if retry_after:
+        frame = rate_limited_frame("upload", retry_after)
+        return JSONResponse(frame, 429, headers={"Retry-After": str(math.ceil(retry_after))})
+
     # Trigger cleanup on upload to save space
     background_tasks.add_task(cleanup_storage)
     
@@ -685,7 +1298,8 @@ async def upload_file(background_tasks: BackgroundTasks, file: UploadFile = File
     return {"url": f"/static/uploads/{filename}", "type": file.content_type}
 
 @app.post("/api/update_avatar")
-async def update_avatar(file: UploadFile = File(...), user_id: str = Form(...)):
+async def update_avatar(file: UploadFile = File(...), user_id: str = Form(...), uid: str = Depends(current_user)):
+    require_self(user_id, uid)
     file_id = str(uuid.uuid4())
     filename = f"avatar_{file_id}.jpg"
     file_path = os.path.join(UPLOAD_DIR, filename)
@@ -697,20 +1311,27 @@ async def update_avatar(file: UploadFile = File(...), user_id: str = Form(...)):
     conn.execute("UPDATE users SET avatar=? WHERE id=?", (url, user_id))
     conn.commit()
     conn.close()
+    profile_cache.invalidate(user_id)
     return {"url": url}
 
 @app.get("/api/search_user")
-async def search_user(query: str):
+async def search_user(query: str, uid: str = Depends(current_user)):
     conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT id, name, avatar FROM users WHERE username=?", (query,))
-    row = c.fetchone()
-    conn.close()
-    if row: return {"id": row['id'], "name": row['name'], "avatar": row['avatar']}
+    try:
+        found, _ = username_cache.get_many([query])
+        user_id = found.get(query)
+        if user_id is None:
+            row = conn.execute("SELECT id FROM users WHERE username=?", (query,)).fetchone()
+            if not row: return {"error": "Not found"}
+            user_id = username_cache.put(query, row['id'])
+        profile = get_users(conn, [user_id]).get(user_id)
+    finally: conn.close()
+    if profile: return {"id": profile['id'], "name": profile['name'], "avatar": profile['avatar']}
     return {"error": "Not found"}
 
 @app.post("/api/create_group")
-async def create_group(name: str = Form(...), user_id: str = Form(...)):
+async def create_group(name: str = Form(...), user_id: str = Form(...), uid: str = Depends(current_user)):
+    require_self(user_id, uid)
     conn = get_db_connection()
     room_id = str(uuid.uuid4())
     invite = str(uuid.uuid4())[:8]
@@ -718,10 +1339,12 @@ async def create_group(name: str = Form(...), user_id: str = Form(...)):
     conn.execute("INSERT INTO room_members VALUES (?, ?)", (room_id, user_id))
     conn.commit()
     conn.close()
+    room_cache.put(room_id, {"id": room_id, "type": "group", "name": name, "invite_link": invite})
     return {"room_id": room_id, "invite_link": invite}
 
 @app.post("/api/join_group")
-async def join_group(invite_link: str = Form(...), user_id: str = Form(...)):
+async def join_group(invite_link: str = Form(...), user_id: str = Form(...), uid: str = Depends(current_user)):
+    require_self(user_id, uid)
     conn = get_db_connection()
     c = conn.cursor()
     c.execute("SELECT * FROM rooms WHERE invite_link=?", (invite_link,))
@@ -735,21 +1358,22 @@ async def join_group(invite_link: str = Form(...), user_id: str = Form(...)):
     return {"status": "ok"}
 
 @app.get("/api/group_info/{room_id}")
-async def group_info(room_id: str):
+async def group_info(room_id: str, uid: str = Depends(current_user)):
     conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT invite_link FROM rooms WHERE id=?", (room_id,))
-    row = c.fetchone()
-    conn.close()
-    return {"invite_link": row['invite_link'] if row else ""}
+    try:
+        require_member(conn, room_id, uid)
+        room = get_rooms(conn, [room_id]).get(room_id)
+    finally: conn.close()
+    return {"invite_link": room['invite_link'] if room else ""}
 
 @app.get("/api/my_chats/{user_id}")
-async def my_chats(user_id: str):
+async def my_chats(user_id: str, uid: str = Depends(current_user)):
+    require_self(user_id, uid)
     conn = get_db_connection()
     c = conn.cursor()
-    c.execute('''SELECT r.id, r.name, r.type, '' as avatar FROM rooms r 
-                 JOIN room_members rm ON r.id = rm.room_id WHERE rm.user_id = ?''', (user_id,))
-    groups = [dict(row) for row in c.fetchall()]
+    c.execute("SELECT room_id FROM room_members WHERE user_id = ?", (user_id,))
+    rooms = get_rooms(conn, [row[0] for row in c.fetchall()])
+    groups = [{"id": r['id'], "name": r['name'], "type": r['type'], "avatar": ''} for r in rooms.values()]
     
     # Simple logic for PV: Find users I have chatted with
     # Complex query to find unique PV partners from messages
@@ -766,75 +1390,308 @@ async def my_chats(user_id: str):
     
     # Fallback: Just return all users excluding self (for easy demo)
     # In production, use the commented logic above
-    c.execute("SELECT id, name, avatar FROM users WHERE id != ?", (user_id,))
-    users = [{"id": row['id'], "name": row['name'], "type": "pv", "avatar": row['avatar']} for row in c.fetchall()]
+    c.execute("SELECT id FROM users WHERE id != ?", (user_id,))
+    profiles = get_users(conn, [row[0] for row in c.fetchall()])
+    users = [{"id": p['id'], "name": p['name'], "type": "pv", "avatar": p['avatar']} for p in profiles.values()]
     
     conn.close()
     return {"groups": groups, "users": users}
 
 @app.get("/api/messages/{room_id}")
-async def get_messages(room_id: str):
+async def get_messages(room_id: str, before: float = None, limit: int = MESSAGE_PAGE, uid: str = Depends(current_user)):
+    # Newest page older than `before`, oldest first; falls through to the archive when the hot table runs out
+    limit = max(1, min(limit, MESSAGE_PAGE_MAX))
+    before = before if before is not None else float("inf")
     conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT * FROM messages WHERE room_id=? ORDER BY timestamp ASC", (room_id,))
-    msgs = [dict(row) for row in c.fetchall()]
-    conn.close()
+    try:
+        require_member(conn, room_id, uid)
+        c = conn.cursor()
+        c.execute("SELECT * FROM messages WHERE room_id=? AND timestamp < ? ORDER BY timestamp DESC LIMIT ?", (room_id, before, limit))
+        msgs = [dict(row) for row in reversed(c.fetchall())]
+    finally: conn.close()
+    if len(msgs) < limit:
+        oldest = msgs[0]['timestamp'] if msgs else before
+        msgs = await asyncio.get_running_loop().run_in_executor(None, read_archive, room_id, oldest, limit - len(msgs)) + msgs
     return msgs
 
+@app.get("/api/stats")
+async def stats(uid: str = Depends(current_user)):
+    return {"connections": len(manager.active_connections), **manager.stats,
+            "rate_buckets": len(limiter.buckets), "rate_limiter": limiter.stats,
+            "profile_cache": profile_cache.stats(), "room_cache": room_cache.stats()}
+
+@app.get("/api/admin/traces")
+async def admin_traces(slow: bool = False, limit: int = 200, uid: str = Depends(admin_user)):
+    spans = [s for s in reversed(trace_buffer) if not slow or s["ms"] >= SLOW_OP_MS]
+    return spans[:limit]
+
+@app.get("/api/admin/profile", response_class=PlainTextResponse)
+async def admin_profile(seconds: float = 10, interval_ms: float = 5, uid: str = Depends(admin_user)):
+    # Samples the event-loop thread from a worker thread, so the server keeps serving meanwhile
+    if not profiler_lock.acquire(blocking=False): raise HTTPException(409, "پروفایلر در حال اجراست")
+    try:
+        seconds = max(0.1, min(seconds, PROFILE_MAX_SECONDS))
+        loop_thread = threading.get_ident()
+        return await asyncio.get_running_loop().run_in_executor(None, sample_stacks, loop_thread, seconds, max(interval_ms, 1) / 1000)
+    finally: profiler_lock.release()
+
 # --- WebSocket Logic ---
 @app.websocket("/ws/{client_id}")
 async def websocket_endpoint(websocket: WebSocket, client_id: str):
-    await manager.connect(websocket, client_id)
+    if verify_token(websocket.query_params.get("token", "")) != client_id:
+        # Accept first so the browser sees 1008 rather than a bare handshake failure
+        await websocket.accept()
+        await websocket.close(code=1008)
+        return
+    if not await manager.connect(websocket, client_id): return
     try:
         while True:
             data = await websocket.receive_text()
+            if manager.active_connections.get(client_id) is websocket: manager.touch(client_id)
+            trace = Trace()
             msg_data = json.loads(data)
             action = msg_data.get("action")
+            if action == "pong": continue
+            trace.mark("parse")
             
-            if action == "message":
-                target_id = msg_data.get("target_id")
-                msg_type = msg_data.get("type", "text")
-                content = msg_data.get("content")
-                is_group = msg_data.get("is_group", False)
-                msg_id = str(uuid.uuid4())
-                timestamp = time.time()
-                
-                if is_group: actual_room_id = target_id
-                else:
-                    ids = sorted([client_id, target_id])
-                    actual_room_id = f"{ids[0]}_{ids[1]}"
-
-                conn = get_db_connection()
-                conn.execute("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)",
-                          (msg_id, actual_room_id, client_id, content, msg_type, "sent", timestamp))
-                conn.commit()
-                conn.close()
+            try:
+                if action == "message":
+                    target_id = msg_data.get("target_id")
+                    msg_type = msg_data.get("type", "text")
+                    content = msg_data.get("content")
+                    is_group = msg_data.get("is_group", False)
+                    msg_id = str(uuid.uuid4())
+                    timestamp = time.time()
+                    
+                    if is_group: actual_room_id = target_id
+                    else:
+                        ids = sorted([client_id, target_id])
+                        actual_room_id = f"{ids[0]}_{ids[1]}"
+
+                    retry_after = limiter.check(client_id, "message")
+                    if is_group and not retry_after:
+                        # Group sends are also charged by fan-out so one flooder can't saturate the worker
+                        conn = get_db_connection()
+                        members = conn.execute("SELECT user_id FROM room_members WHERE room_id=?", (target_id,)).fetchall()
+                        conn.close()
+                        trace.mark("members")
+                        if not any(m[0] == client_id for m in members):
+                            await manager.send_personal_message(FORBIDDEN_FRAME, client_id)
+                            continue
+                        retry_after = limiter.check(client_id, "group_fanout", cost=len(members))
+                        # Only charge the message budget when both buckets let the send through
+                        if retry_after: limiter.refund(client_id, "message")
+                    trace.mark("rate_limit")
+                    if retry_after:
+                        await manager.send_personal_message(rate_limited_frame(action, retry_after), client_id)
+                        continue
 
-                payload = {"action": "new_message", "id": msg_id, "sender_id": client_id, "room_id": actual_room_id, "content": content, "type": msg_type, "timestamp": timestamp, "status": "sent"}
-                
-                # Send to sender (immediate feedback)
-                await manager.send_personal_message(payload, client_id)
-                
-                if is_group:
                     conn = get_db_connection()
-                    members = conn.execute("SELECT user_id FROM room_members WHERE room_id=?", (target_id,)).fetchall()
+                    conn.execute("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (msg_id, actual_room_id, client_id, content, msg_type, "sent", timestamp))
+                    conn.commit()
                     conn.close()
-                    for m in members:
-                        if m[0] != client_id: await manager.send_personal_message(payload, m[0])
-                else:
-                    await manager.send_personal_message(payload, target_id)
-            
-            elif action == "read":
-                msg_id = msg_data.get("msg_id")
-                sender = msg_data.get("sender_id")
-                conn = get_db_connection()
-                conn.execute("UPDATE messages SET status='seen' WHERE id=?", (msg_id,))
-                conn.commit()
-                conn.close()
-                await manager.send_personal_message({"action": "status_update", "msg_id": msg_id, "status": "seen"}, sender)
+                    trace.mark("db_insert")
+
+                    payload = {"action": "new_message", "id": msg_id, "sender_id": client_id, "room_id": actual_room_id, "content": content, "type": msg_type, "timestamp": timestamp, "status": "sent"}
+                    
+                    # Send to sender (immediate feedback)
+                    await manager.send_personal_message(payload, client_id)
+                    trace.mark("send_self")
+                    
+                    if is_group:
+                        for m in members:
+                            if m[0] != client_id: await manager.send_personal_message(payload, m[0])
+                    else:
+                        await manager.send_personal_message(payload, target_id)
+                    trace.mark("fanout")
+                
+                elif action == "read":
+                    retry_after = limiter.check(client_id, "read")
+                    trace.mark("rate_limit")
+                    if retry_after:
+                        await manager.send_personal_message(rate_limited_frame(action, retry_after), client_id)
+                        continue
+                    msg_id = msg_data.get("msg_id")
+                    conn = get_db_connection()
+                    try:
+                        # The sender comes from the row, and only members of the message's room may mark it seen
+                        row = conn.execute("SELECT room_id, sender_id FROM messages WHERE id=?", (msg_id,)).fetchone()
+                        if not row or not is_member(conn, row['room_id'], client_id):
+                            await manager.send_personal_message(FORBIDDEN_FRAME, client_id)
+                            continue
+                        sender = row['sender_id']
+                        conn.execute("UPDATE messages SET status='seen' WHERE id=?", (msg_id,))
+                        conn.commit()
+                    finally: conn.close()
+                    trace.mark("db_update")
+                    await manager.send_personal_message({"action": "status_update", "msg_id": msg_id, "status": "seen"}, sender)
+                    trace.mark("send")
+            finally: trace.finish(f"ws.{action}", user=client_id)
+
+    except WebSocketDisconnect: manager.disconnect(client_id, websocket)
+
+# --- Backup: streaming export / import ---
+BACKUP_TABLES = ("users", "rooms", "room_members", "messages")
+
+def export_records(conn, rooms: List[str] = None, since: float = None, until: float = None):
+    """Yields one dict per row, tagged with its table. Everything is read inside a
+    single transaction so the snapshot is consistent, and rows are streamed off the
+    cursor so memory stays flat regardless of history size."""
+    conn.execute("BEGIN")
+    room_filter, room_args = "", []
+    if rooms:
+        room_filter = f" WHERE {{col}} IN ({','.join('?' * len(rooms))})"
+        room_args = list(rooms)
+    yield {"table": "meta", "version": 1, "exported_at": time.time()}
+    for row in conn.execute("SELECT * FROM users"):
+        yield {"table": "users", **dict(row)}
+    for row in conn.execute("SELECT * FROM rooms" + room_filter.format(col="id"), room_args):
+        yield {"table": "rooms", **dict(row)}
+    for row in conn.execute("SELECT * FROM room_members" + room_filter.format(col="room_id"), room_args):
+        yield {"table": "room_members", **dict(row)}
+    query, args = "SELECT * FROM messages" + room_filter.format(col="room_id"), list(room_args)
+    for clause, value in (("timestamp >= ?", since), ("timestamp < ?", until)):
+        if value is None: continue
+        query += (" AND " if args else " WHERE ") + clause
+        args.append(value)
+    for row in conn.execute(query, args):
+        yield {"table": "messages", **dict(row)}
+    # Archived history, via the segment index read in the same snapshot. Databases from
+    # before archiving have no index table; they are exported as-is, without migrating them.
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='archive_segments'").fetchone():
+        conn.execute("COMMIT")
+        return
+    query, args = "SELECT path, offset, length FROM archive_segments" + room_filter.format(col="room_id"), list(room_args)
+    for clause, value in (("last_ts >= ?", since), ("first_ts < ?", until)):
+        if value is None: continue
+        query += (" AND " if args else " WHERE ") + clause
+        args.append(value)
+    for path, offset, length in conn.execute(query, args).fetchall():
+        for msg in read_segment(path, offset, length):
+            if (since is None or msg["timestamp"] >= since) and (until is None or msg["timestamp"] < until):
+                yield {"table": "messages", **msg}
+    conn.execute("COMMIT")
+
+def _encode_lines(records, counts: Dict[str, int]):
+    for record in records:
+        counts[record["table"]] = counts.get(record["table"], 0) + 1
+        yield json.dumps(record, ensure_ascii=False) + "\n"
+
+def export_ndjson(path: str, db_name: str = DB_NAME, **filters) -> Dict[str, int]:
+    conn = sqlite3.connect(db_name, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    counts = dict.fromkeys(BACKUP_TABLES, 0)
+    try:
+        lines = _encode_lines(export_records(conn, **filters), counts)
+        with gzip.open(path, "wt", encoding="utf-8", compresslevel=6) as out:
+            while True:
+                chunk = list(itertools.islice(lines, 10000))
+                if not chunk: break
+                out.writelines(chunk)
+    finally: conn.close()
+    counts.pop("meta", None)
+    return counts
+
+def read_ndjson(path: str):
+    with gzip.open(path, "rt", encoding="utf-8") as src:
+        for line in src:
+            if line.strip(): yield json.loads(line)
+
+def import_records(conn, records, batch_size: int = 10000, commit_every: int = 500000) -> Dict[str, int]:
+    """Bulk-loads records with executemany in large transactions. Secondary indexes
+    are dropped for the duration and rebuilt once at the end. Existing rows are kept
+    (INSERT OR IGNORE), so re-running an import is harmless."""
+    marks = ",".join("?" * len(BACKUP_TABLES))
+    indexes = conn.execute(f"SELECT name, sql FROM sqlite_master WHERE type='index' AND sql IS NOT NULL AND tbl_name IN ({marks})", BACKUP_TABLES).fetchall()
+    for name, _ in indexes: conn.execute(f'DROP INDEX "{name}"')
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("BEGIN")
+    counts = dict.fromkeys(BACKUP_TABLES, 0)
+    pending: Dict[str, list] = {t: [] for t in BACKUP_TABLES}
+    # Column lists come from the schema, never from record keys
+    columns = {t: tuple(row[1] for row in conn.execute(f'PRAGMA table_info("{t}")')) for t in BACKUP_TABLES}
+    known = {t: set(cols) for t, cols in columns.items()}
+    inserts = {}
+    for t, cols in columns.items():
+        names = ",".join(f'"{c}"' for c in cols)
+        inserts[t] = f'INSERT OR IGNORE INTO "{t}" ({names}) VALUES ({",".join("?" * len(cols))})'
+    warned = set()
+    since_commit = 0
+
+    def flush(table):
+        rows = pending[table]
+        if not rows: return
+        # INSERT OR IGNORE skips existing rows, so count what actually went in
+        before = conn.total_changes
+        conn.executemany(inserts[table], rows)
+        counts[table] += conn.total_changes - before
+        pending[table] = []
+
+    try:
+        for record in records:
+            table = record.pop("table")
+            if table not in pending: continue
+            cols = columns[table]
+            for key in record.keys() - known[table]:
+                if (table, key) in warned: continue
+                warned.add((table, key))
+                print(f"Import: ignoring unknown field {table}.{key}")
+            pending[table].append(tuple(record.get(c) for c in cols))
+            if len(pending[table]) >= batch_size:
+                flush(table)
+                since_commit += batch_size
+                if since_commit >= commit_every:
+                    conn.execute("COMMIT")
+                    conn.execute("BEGIN")
+                    since_commit = 0
+        for table in BACKUP_TABLES: flush(table)
+        conn.execute("COMMIT")
+    finally:
+        # On error, roll back the open batch first: the pragma and the index rebuild can't run inside it
+        if conn.in_transaction: conn.execute("ROLLBACK")
+        for _, sql in indexes: conn.execute(sql)
+        conn.execute("PRAGMA synchronous=FULL")
+    return counts
+
+def import_ndjson(path: str, db_name: str = DB_NAME, batch_size: int = 10000) -> Dict[str, int]:
+    init_db(db_name)
+    conn = sqlite3.connect(db_name, isolation_level=None)
+    try: return import_records(conn, read_ndjson(path), batch_size=batch_size)
+    finally: conn.close()
 
-    except WebSocketDisconnect: manager.disconnect(client_id)
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="KRALGRAM server and backup tools")
+    sub = parser.add_subparsers(dest="command")
+    sub.add_parser("serve", help="run the chat server (default)")
+    exp = sub.add_parser("export", help="stream a snapshot to gzipped NDJSON")
+    exp.add_argument("out")
+    exp.add_argument("--db", default=DB_NAME)
+    exp.add_argument("--room", action="append", dest="rooms", help="room id to include (repeatable)")
+    exp.add_argument("--since", type=float, help="unix timestamp, inclusive")
+    exp.add_argument("--until", type=float, help="unix timestamp, exclusive")
+    imp = sub.add_parser("import", help="bulk-load a gzipped NDJSON export")
+    imp.add_argument("src")
+    imp.add_argument("--db", default=DB_NAME)
+    imp.add_argument("--batch", type=int, default=10000)
+    arc = sub.add_parser("archive", help="move old messages into archive segments now")
+    arc.add_argument("--db", default=DB_NAME)
+    arc.add_argument("--days", type=float, default=ARCHIVE_AFTER / 86400)
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        start = time.time()
+        counts = export_ndjson(args.out, args.db, rooms=args.rooms, since=args.since, until=args.until)
+        print(f"Exported {counts} in {time.time() - start:.1f}s")
+    elif args.command == "import":
+        start = time.time()
+        counts = import_ndjson(args.src, args.db, batch_size=args.batch)
+        print(f"Imported {counts} in {time.time() - start:.1f}s")
+    elif args.command == "archive":
+        archive_messages(args.db, older_than=args.days * 86400)
+    else:
+        port = int(os.environ.get("PORT", 8000))
+        DrainingServer(uvicorn.Config(app, host="0.0.0.0", port=port)).run()
 
 if __name__ == "__main__":
-    port = int(os.environ.get("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
+    cli()
\ No newline at end of file